@@ -1,12 +1,17 @@
 import asyncio
-import json
 import os
-from datetime import datetime
+import time
+from asyncio.subprocess import Process
+from collections import deque
+from collections.abc import Awaitable, Callable, Hashable, Iterable
 from enum import Enum
+from operator import attrgetter
+from typing import TypeVar
 
 import aiohttp
+import msgspec
+import orjson
 from loguru import logger
-from pydantic import BaseModel
 
 from model import (
     ChatProvider,
@@ -17,18 +22,28 @@ from model import (
     SendMessage,
 )
 
+T = TypeVar("T")
 
-class WhoamiResponse(BaseModel):
-    class User(BaseModel):
+# How long Keybase chat API results are reused across requests, in seconds
+CACHE_TTL = 5
+
+KEYBASE_LOOKUP_URL = "https://keybase.io/_/api/1.0/user/lookup.json"
+
+# Builds an initials avatar URL from a display name
+DICEBEAR = "https://api.dicebear.com/7.x/initials/svg?seed=".__add__
+
+
+class WhoamiResponse(msgspec.Struct, frozen=True):
+    class User(msgspec.Struct, frozen=True):
         uid: str
         username: str
 
     user: User
 
 
-class ListMembersResponse(BaseModel):
-    class Result(BaseModel):
-        class Owner(BaseModel):
+class ListMembersResponse(msgspec.Struct, frozen=True):
+    class Result(msgspec.Struct, frozen=True):
+        class Owner(msgspec.Struct, frozen=True):
             uid: str
             username: str
             fullName: str | None
@@ -38,10 +53,10 @@ class ListMembersResponse(BaseModel):
     result: Result
 
 
-class ListResponse(BaseModel):
-    class Result(BaseModel):
-        class Conversation(BaseModel):
-            class Channel(BaseModel):
+class ListResponse(msgspec.Struct, frozen=True):
+    class Result(msgspec.Struct, frozen=True):
+        class Conversation(msgspec.Struct, frozen=True):
+            class Channel(msgspec.Struct, frozen=True):
                 class MemberType(str, Enum):
                     # pylint: disable=invalid-name
                     impteamnative = "impteamnative"
@@ -52,7 +67,6 @@ class ListResponse(BaseModel):
 
             id: str
             channel: Channel
-            active_at: int
             active_at_ms: int
 
         conversations: list[Conversation]
@@ -60,35 +74,50 @@ class ListResponse(BaseModel):
     result: Result
 
 
-class ReadResponse(BaseModel):
-    class Result(BaseModel):
-        class KeybaseMessage(BaseModel):
-            class KeybaseMsg(BaseModel):
-                class KeybaseContent(BaseModel):
-                    class KeybaseText(BaseModel):
+class ReadResponse(msgspec.Struct, frozen=True):
+    class Result(msgspec.Struct, frozen=True):
+        class KeybaseMessage(msgspec.Struct, frozen=True):
+            class KeybaseMsg(msgspec.Struct, frozen=True):
+                class KeybaseContent(msgspec.Struct, frozen=True):
+                    class KeybaseText(msgspec.Struct, frozen=True):
                         body: str
 
-                    type: str
                     text: KeybaseText | None = None
 
-                class KeybaseSender(BaseModel):
+                class KeybaseSender(msgspec.Struct, frozen=True):
                     uid: str
 
-                id: int
                 sender: KeybaseSender
                 sent_at: int
                 content: KeybaseContent
 
-            msg: KeybaseMsg
+            # Messages that failed to unbox carry an error instead of msg
+            msg: KeybaseMsg | None = None
 
         messages: list[KeybaseMessage]
 
     result: Result
 
 
+JSON_DECODER = msgspec.json.Decoder()
+WHOAMI_DECODER = msgspec.json.Decoder(WhoamiResponse)
+LIST_MEMBERS_DECODER = msgspec.json.Decoder(ListMembersResponse)
+LIST_DECODER = msgspec.json.Decoder(ListResponse)
+READ_DECODER = msgspec.json.Decoder(ReadResponse)
+
+
 class KeybaseChatProvider(ChatProvider):
+    # pylint: disable=too-many-instance-attributes
+
     def __init__(self) -> None:
         self.keybase_command = os.environ.get("KEYBASE_COMMAND", "keybase")
+        self._session: aiohttp.ClientSession | None = None
+        self._chat_process: Process | None = None
+        self._chat_reader: asyncio.Task | None = None
+        self._chat_pending: deque[asyncio.Future[bytes]] = deque()
+        self._chat_lock = asyncio.Lock()
+        self._cache: dict[Hashable, tuple[float, asyncio.Task]] = {}
+        self._me: Contact | None = None
 
     def info(self) -> ChatProviderInfo:
         return ChatProviderInfo(
@@ -97,7 +126,7 @@ class KeybaseChatProvider(ChatProvider):
             icon="https://keybase.io/images/icons/icon-keybase-logo-48@2x.png",
         )
 
-    async def _run(self, command: list[str]):
+    async def _run(self, command: list[str]) -> bytes:
         full_command = self.keybase_command.split() + command
         logger.trace(f"Keybase command: {full_command}")
 
@@ -108,77 +137,198 @@ class KeybaseChatProvider(ChatProvider):
             stderr=asyncio.subprocess.PIPE,
         )
 
-        if await process.wait() != 0:
+        stdout, stderr = await process.communicate()
+        if process.returncode:
             raise RuntimeError(
                 "\n\t".join(
                     (
                         "Keybase command failed:",
                         f"Code: {process.returncode}",
-                        f"Output: {(await process.stdout.read()).decode()}",
-                        f"Error: {(await process.stderr.read()).decode()}",
+                        f"Output: {stdout.decode()}",
+                        f"Error: {stderr.decode()}",
                     )
                 )
             )
 
-        result = await process.stdout.read()
-        result = result.decode()
-        logger.trace(f"Keybase result: {result}")
-        return result
-
-    async def _chat(self, command: dict) -> dict:
-        result = await self._run(
-            [
-                "chat",
-                "api",
-                "-m",
-                json.dumps(command),
-            ]
+        logger.trace(f"Keybase result: {stdout}")
+        return stdout
+
+    async def _read_chat_responses(
+        self, process: Process, pending: deque[asyncio.Future[bytes]]
+    ) -> None:
+        try:
+            # The chat API answers requests one line each, in the order they were sent
+            while result := await process.stdout.readline():
+                logger.trace(f"Keybase result: {result}")
+                future = pending.popleft()
+                if not future.done():
+                    future.set_result(result)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Keybase chat API response could not be read")
+        finally:
+            # Never leave callers waiting: the next _chat() starts a fresh process
+            if process.returncode is None:
+                process.kill()
+            error = RuntimeError(
+                f"Keybase chat API exited with code {await process.wait()}"
+            )
+            while pending:
+                future = pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _start_chat(self) -> None:
+        full_command = self.keybase_command.split() + ["chat", "api"]
+        logger.trace(f"Keybase command: {full_command}")
+        self._chat_process = await asyncio.create_subprocess_exec(
+            full_command[0],
+            *full_command[1:],
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # Read responses can be far larger than the default 64 KiB line limit
+            limit=2**24,
         )
-        return json.loads(result)
+        self._chat_pending = deque()
+        self._chat_reader = asyncio.create_task(
+            self._read_chat_responses(self._chat_process, self._chat_pending)
+        )
+
+    async def _chat(
+        self, command: dict, decoder: msgspec.json.Decoder[T] = JSON_DECODER
+    ) -> T:
+        async with self._chat_lock:
+            if self._chat_reader is None or self._chat_reader.done():
+                await self._start_chat()
+
+        logger.trace(f"Keybase chat command: {command}")
+        process = self._chat_process
+        future = asyncio.get_running_loop().create_future()
+        self._chat_pending.append(future)
+        process.stdin.write(orjson.dumps(command) + b"\n")
+        await process.stdin.drain()
+
+        result = await future
+        try:
+            return decoder.decode(result)
+        except msgspec.ValidationError as e:
+            raise RuntimeError(f"Keybase chat API failed: {result.decode()}") from e
 
     async def init(self) -> None:
-        pass
-
-    async def _lookup(self, username: str) -> Contact:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://keybase.io/_/api/1.0/user/lookup.json",
-                params={"username": username, "fields": "basics,profile,pictures"},
-            ) as response:
-                data = await response.json()
-
-            user = data["them"]
-            full_name = user["profile"]["full_name"] if "profile" in user else username
-            return Contact(
-                id=user["id"],
-                name=full_name,
-                avatar=user["pictures"]["primary"]["url"]
-                if "pictures" in user
-                else f"https://api.dicebear.com/7.x/initials/svg?seed={full_name}",
-            )
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+        )
 
-    async def whoami(self) -> Contact:
+    async def close(self) -> None:
+        if self._chat_reader:
+            self._chat_process.stdin.close()
+            await self._chat_reader
+        if self._session:
+            await self._session.close()
+
+    async def _load_me(self) -> Contact:
         data = await self._run("whoami -j".split())
-        response = WhoamiResponse(**json.loads(data))
-        contact = await self._lookup(response.user.username)
-        return Contact(
-            id=response.user.uid,
-            name=response.user.username,
-            avatar=contact.avatar,
+        user = WHOAMI_DECODER.decode(data).user
+        lookup = (await self._lookup_users([user.username])).get(user.username, {})
+        profile = lookup.get("profile")
+        pictures = lookup.get("pictures")
+        full_name = profile["full_name"] if profile else user.username
+        return Contact.model_construct(
+            id=user.uid,
+            name=user.username,
+            avatar=pictures["primary"]["url"] if pictures else DICEBEAR(full_name),
+        )
+
+    async def whoami(self) -> Contact:
+        # Only a successful lookup is kept, so a logged-out CLI is retried next time
+        if self._me is None:
+            self._me = await self._cached("whoami", self._load_me)
+
+        return self._me
+
+    def _cache_get(self, key: Hashable) -> asyncio.Task | None:
+        # Failed or cancelled loads are not cached
+        expires, task = self._cache.get(key, (0.0, None))
+        if (
+            task is None
+            or expires <= time.monotonic()
+            or (task.done() and (task.cancelled() or task.exception()))
+        ):
+            return None
+
+        return task
+
+    def _cache_put(self, key: Hashable, task: asyncio.Task) -> None:
+        self._cache[key] = (time.monotonic() + CACHE_TTL, task)
+
+    async def _cached(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        # Concurrent callers share the same in-flight task
+        task = self._cache_get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._cache_put(key, task)
+
+        return await asyncio.shield(task)
+
+    async def _fetch_users(self, usernames: list[str]) -> dict[str, dict]:
+        async with self._session.get(
+            KEYBASE_LOOKUP_URL,
+            params={
+                "usernames": ",".join(usernames),
+                "fields": "basics,profile,pictures",
+            },
+        ) as response:
+            data = orjson.loads(await response.read())
+
+        users = {}
+        for user in data["them"]:
+            # Unknown usernames come back as null
+            if user:
+                users[user["basics"]["username"]] = user
+
+        return users
+
+    async def _lookup_users(self, usernames: Iterable[str]) -> dict[str, dict]:
+        # Users are cached one by one so /contacts and /conversations share lookups
+        tasks: dict[str, asyncio.Task] = {}
+        missing: list[str] = []
+        for username in dict.fromkeys(usernames):
+            task = self._cache_get(("user", username))
+            if task is None:
+                missing.append(username)
+            else:
+                tasks[username] = task
+
+        if missing:
+            task = asyncio.ensure_future(self._fetch_users(missing))
+            for username in missing:
+                self._cache_put(("user", username), task)
+                tasks[username] = task
+
+        users: dict[str, dict] = {}
+        for task in set(tasks.values()):
+            users.update(await asyncio.shield(task))
+
+        return users
+
+    async def _list(self) -> ListResponse:
+        return await self._cached(
+            "list", lambda: self._chat({"method": "list"}, LIST_DECODER)
         )
 
     async def _list_members(self, conversation_id: str) -> ListMembersResponse:
-        data = await self._chat(
-            {
-                "method": "listmembers",
-                "params": {"options": {"conversation_id": conversation_id}},
-            }
+        return await self._cached(
+            ("listmembers", conversation_id),
+            lambda: self._chat(
+                {
+                    "method": "listmembers",
+                    "params": {"options": {"conversation_id": conversation_id}},
+                },
+                LIST_MEMBERS_DECODER,
+            ),
         )
-        return ListMembersResponse(**data)
 
     async def contacts(self) -> list[Contact]:
-        data = await self._chat({"method": "list"})
-        list_response = ListResponse(**data)
+        list_response = await self._list()
         conversations = list_response.result.conversations
 
         conversation_members_list = await asyncio.gather(
@@ -187,39 +337,30 @@ class KeybaseChatProvider(ChatProvider):
 
         owners = {o.uid: o for r in conversation_members_list for o in r.result.owners}
 
-        usernames = ",".join(o.username for o in owners.values())
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"https://keybase.io/_/api/1.0/user/lookup.json?usernames={usernames}&fields=basics,pictures"
-            ) as response:
-                user_infos = await response.json()
-                avatars = {
-                    u["basics"]["username"]: u["pictures"]["primary"]["url"]
-                    for u in user_infos["them"]
-                    if "pictures" in u
-                }
+        users = await self._lookup_users(o.username for o in owners.values())
 
         def owner_to_contact(o: ListMembersResponse.Result.Owner) -> Contact:
             name = o.fullName if o.fullName else o.username
-            contact = Contact(
+            pictures = users.get(o.username, {}).get("pictures")
+            contact = Contact.model_construct(
                 id=o.uid,
                 name=name,
-                avatar=avatars.get(
-                    o.username, f"https://api.dicebear.com/7.x/initials/svg?seed={name}"
-                ),
+                avatar=pictures["primary"]["url"] if pictures else DICEBEAR(name),
             )
             return contact
 
         return list(owner_to_contact(o) for o in owners.values())
 
     async def conversations(self) -> list[Conversation]:
-        me = WhoamiResponse(
-            **json.loads(await self._run("whoami -j".split()))
-        ).user.username
-        data = await self._chat({"method": "list"})
-        list_response = ListResponse(**data)
+        me = (await self.whoami()).name
+        list_response = await self._list()
         conversations = list_response.result.conversations
 
+        # Local bindings for the per-conversation hot path
+        team = ListResponse.Result.Conversation.Channel.MemberType.team
+        construct = Conversation.model_construct
+        dicebear = DICEBEAR
+
         def get_username(channel: ListResponse.Result.Conversation.Channel) -> str:
             usernames = channel.name.split(",")
 
@@ -232,58 +373,46 @@ class KeybaseChatProvider(ChatProvider):
 
             return usernames[0]
 
-        individual_channels = [
-            c.channel
+        usernames = {
+            c.id: get_username(c.channel)
             for c in conversations
-            if c.channel.members_type
-            != ListResponse.Result.Conversation.Channel.MemberType.team
-        ]
+            if c.channel.members_type != team
+        }
 
-        usernames = ",".join(map(get_username, individual_channels))
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://keybase.io/_/api/1.0/user/lookup.json",
-                params={"usernames": usernames, "fields": "basics,profile,pictures"},
-            ) as response:
-                data = await response.json()
-                users = {u["basics"]["username"]: u for u in data["them"] if u}
+        users = await self._lookup_users(usernames.values())
 
         def map_conversation(
             conversation: ListResponse.Result.Conversation,
         ) -> Conversation:
-            if (
-                conversation.channel.members_type
-                == ListResponse.Result.Conversation.Channel.MemberType.team
-            ):
-                return Conversation(
+            if conversation.channel.members_type == team:
+                return construct(
                     id=conversation.id,
                     name=conversation.channel.name,
-                    avatar=f"https://api.dicebear.com/7.x/initials/svg?seed={conversation.channel.name}",
-                    last_active=datetime.fromtimestamp(
-                        conversation.active_at_ms / 1000
-                    ),
+                    avatar=dicebear(conversation.channel.name),
+                    last_active_ms=conversation.active_at_ms,
                 )
 
-            username = get_username(conversation.channel)
+            username = usernames[conversation.id]
             user = users.get(username, {})
-            full_name = user["profile"]["full_name"] if "profile" in user else username
-            return Conversation(
+            profile = user.get("profile")
+            pictures = user.get("pictures")
+            full_name = profile["full_name"] if profile else username
+            return construct(
                 id=conversation.id,
                 name=full_name,
-                avatar=user["pictures"]["primary"]["url"]
-                if "pictures" in user
-                else f"https://api.dicebear.com/7.x/initials/svg?seed={full_name}",
-                last_active=datetime.fromtimestamp(conversation.active_at_ms / 1000),
+                avatar=pictures["primary"]["url"] if pictures else dicebear(full_name),
+                last_active_ms=conversation.active_at_ms,
             )
 
-        return sorted(
-            map(map_conversation, conversations),
-            key=lambda c: c.last_active,
-            reverse=True,
+        return list(
+            map(
+                map_conversation,
+                sorted(conversations, key=attrgetter("active_at_ms"), reverse=True),
+            )
         )
 
     async def messages(self, conversation_id: str = None):
-        data = await self._chat(
+        read_response = await self._chat(
             {
                 "method": "read",
                 "params": {
@@ -292,23 +421,30 @@ class KeybaseChatProvider(ChatProvider):
                         "pagination": {"num": 100},
                     }
                 },
-            }
-        )
-        read_response = ReadResponse(**data)
-        return sorted(
-            (
-                Message(
-                    timestamp=datetime.fromtimestamp(message.msg.sent_at),
-                    body=message.msg.content.text.body,
-                    sender=message.msg.sender.uid,
-                )
-                for message in read_response.result.messages
-                if message.msg.content.text
-            ),
-            key=lambda m: m.timestamp,
+            },
+            READ_DECODER,
         )
+        # Drop non-text and failed messages before sorting what is left
+        text_msgs = [
+            message.msg
+            for message in read_response.result.messages
+            if message.msg and message.msg.content.text
+        ]
+        text_msgs.sort(key=attrgetter("sent_at"))
+
+        construct = Message.model_construct
+        return [
+            construct(
+                timestamp_ms=msg.sent_at * 1000,
+                body=msg.content.text.body,
+                sender=msg.sender.uid,
+            )
+            for msg in text_msgs
+        ]
 
     async def send_message(self, request: SendMessage):
+        # Sending bumps the conversation's activity time
+        self._cache.pop("list", None)
         return await self._chat(
             {
                 "method": "send",
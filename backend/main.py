@@ -1,32 +1,42 @@
 import asyncio
-import inspect
 import logging
+import sys
 from contextlib import asynccontextmanager
-from typing import Annotated
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, Header
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import ORJSONResponse
 from loguru import logger
+from pydantic import TypeAdapter
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from keybase import KeybaseChatProvider
 from mockchat import MockChatProvider
-from model import ChatProvider, SendMessage
+from model import ChatProvider, Conversation, Message, SendMessage
 
 load_dotenv()
 
+LOGGING_FILE = logging.__file__
+
 
 class InterceptHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self._levels: dict[int, str | int] = {}
+
     def emit(self, record: logging.LogRecord) -> None:
         # Get corresponding Loguru level if it exists.
-        level: str | int
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+        level = self._levels.get(record.levelno)
+        if level is None:
+            try:
+                level = logger.level(record.levelname).name
+            except ValueError:
+                level = record.levelno
+            self._levels[record.levelno] = level
 
         # Find caller from where originated the logged message.
-        frame, depth = inspect.currentframe(), 0
-        while frame and (depth == 0 or frame.f_code.co_filename == logging.__file__):
+        frame, depth = sys._getframe(1), 1  # pylint: disable=protected-access
+        while frame and frame.f_code.co_filename == LOGGING_FILE:
             frame = frame.f_back
             depth += 1
 
@@ -40,12 +50,37 @@ logging.basicConfig(handlers=[InterceptHandler()], level=logging.INFO, force=Tru
 _providers: list[ChatProvider] = [KeybaseChatProvider(), MockChatProvider()]
 _providers_map = {provider.info().id: provider for provider in _providers}
 
+# Serialise the largest responses straight to JSON bytes, skipping jsonable_encoder
+CONVERSATIONS_ADAPTER = TypeAdapter(list[Conversation])
+MESSAGES_ADAPTER = TypeAdapter(list[Message])
+
+
+class ProviderMiddleware:
+    def __init__(self, asgi_app: ASGIApp) -> None:
+        self.app = asgi_app
 
-def get_provider(provider_id: Annotated[str, Header()]):
-    return _providers_map[provider_id]
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # Resolve the provider-id header into request.state.provider
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"provider-id":
+                    provider = _providers_map.get(value.decode())
+                    if provider:
+                        scope.setdefault("state", {})["provider"] = provider
+                    break
 
+        await self.app(scope, receive, send)
 
-ChatProviderDependency = Annotated[ChatProvider, Depends(get_provider)]
+
+def get_provider(request: Request) -> ChatProvider:
+    provider = getattr(request.state, "provider", None)
+    if provider is None:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "Missing or unknown provider-id header",
+        )
+
+    return provider
 
 
 @asynccontextmanager
@@ -55,8 +90,11 @@ async def lifespan(_: FastAPI):
 
     yield
 
+    await asyncio.gather(*list(p.close() for p in _providers))
+
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(ProviderMiddleware)
 
 
 @app.get("/providers")
@@ -65,28 +103,36 @@ async def providers():
 
 
 @app.get("/whoami")
-async def whoami(provider: ChatProviderDependency):
-    return await provider.whoami()
+async def whoami(request: Request):
+    return await get_provider(request).whoami()
 
 
 @app.get("/contacts")
-async def contacts(provider: ChatProviderDependency):
-    return await provider.contacts()
+async def contacts(request: Request):
+    return await get_provider(request).contacts()
 
 
-@app.get("/conversations")
-async def conversations(provider: ChatProviderDependency):
-    return await provider.conversations()
+@app.get("/conversations", response_model=None)
+async def conversations(request: Request):
+    return Response(
+        CONVERSATIONS_ADAPTER.dump_json(await get_provider(request).conversations()),
+        media_type="application/json",
+    )
 
 
-@app.get("/messages")
+@app.get("/messages", response_model=None)
 async def messages(
-    provider: ChatProviderDependency,
+    request: Request,
     conversation_id: str,
 ):
-    return await provider.messages(conversation_id)
+    return Response(
+        MESSAGES_ADAPTER.dump_json(
+            await get_provider(request).messages(conversation_id)
+        ),
+        media_type="application/json",
+    )
 
 
 @app.post("/messages")
-async def send_message(provider: ChatProviderDependency, request: SendMessage):
-    return await provider.send_message(request)
+async def send_message(request: Request, message: SendMessage):
+    return await get_provider(request).send_message(message)
@@ -1,7 +1,9 @@
+import asyncio
 import random
-from datetime import datetime
+import time
 
 import aiohttp
+import orjson
 
 from model import (
     ChatProvider,
@@ -16,6 +18,7 @@ from model import (
 class MockChatProvider(ChatProvider):
     def __init__(self) -> None:
         super().__init__()
+        self._session: aiohttp.ClientSession | None = None
         self._me: Contact = None
         self._contacts: list[Contact] = []
         self._conversations: list[Conversation] = []
@@ -29,43 +32,53 @@ class MockChatProvider(ChatProvider):
         )
 
     async def init(self) -> None:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://randomuser.me/api/?results=11") as response:
-                data = await response.json()
-
-                all_contacts = [
-                    Contact(
-                        id=result["login"]["uuid"],
-                        name=f"""{result["name"]["first"]} {result["name"]["last"]}""",
-                        avatar=result["picture"]["thumbnail"],
-                    )
-                    for result in data["results"]
-                ]
-                self._me = all_contacts[0]
-                self._contacts = all_contacts[1:]
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+
+        async with self._session.get(
+            "https://randomuser.me/api/?results=11"
+        ) as response:
+            data = orjson.loads(await response.read())
+
+            all_contacts = [
+                Contact.model_construct(
+                    id=result["login"]["uuid"],
+                    name=f"""{result["name"]["first"]} {result["name"]["last"]}""",
+                    avatar=result["picture"]["thumbnail"],
+                )
+                for result in data["results"]
+            ]
+            self._me = all_contacts[0]
+            self._contacts = all_contacts[1:]
 
         self._conversations = [
-            Conversation(**contact.model_dump()) for contact in await self.contacts()
+            Conversation.model_construct(**contact.__dict__)
+            for contact in await self.contacts()
         ]
 
         async def get_messages(conversation_id: str):
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    "https://baconipsum.com/api/?type=meat-and-filler"
-                ) as response:
-                    return [
-                        Message(
-                            timestamp=datetime.now(),
-                            body=bacon,
-                            sender=random.choice([conversation_id, self._me.id]),
-                        )
-                        for bacon in await response.json()
-                    ]
-
-        self._messages = {
-            conversation.id: await get_messages(conversation.id)
-            for conversation in self._conversations
-        }
+            async with self._session.get(
+                "https://baconipsum.com/api/?type=meat-and-filler"
+            ) as response:
+                return [
+                    Message.model_construct(
+                        timestamp_ms=time.time_ns() // 1_000_000,
+                        body=bacon,
+                        sender=random.choice([conversation_id, self._me.id]),
+                    )
+                    for bacon in orjson.loads(await response.read())
+                ]
+
+        conversation_ids = [conversation.id for conversation in self._conversations]
+        conversation_messages = await asyncio.gather(
+            *[get_messages(conversation_id) for conversation_id in conversation_ids]
+        )
+        self._messages = dict(zip(conversation_ids, conversation_messages))
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
 
     async def whoami(self) -> Contact:
         return self._me
@@ -81,5 +94,9 @@ class MockChatProvider(ChatProvider):
 
     async def send_message(self, request: SendMessage) -> None:
         self._messages[request.conversation_id].append(
-            Message(timestamp=datetime.now(), body=request.body, sender=self._me.id)
+            Message(
+                timestamp_ms=time.time_ns() // 1_000_000,
+                body=request.body,
+                sender=self._me.id,
+            )
         )
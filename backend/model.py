@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, computed_field
 
 
 class Contact(BaseModel):
@@ -14,14 +14,27 @@ class Conversation(BaseModel):
     id: str
     name: str
     avatar: str
-    last_active: datetime = None
+    last_active_ms: int | None = Field(default=None, exclude=True)
+
+    @computed_field
+    @property
+    def last_active(self) -> datetime | None:
+        if self.last_active_ms is None:
+            return None
+
+        return datetime.fromtimestamp(self.last_active_ms / 1000)
 
 
 class Message(BaseModel):
-    timestamp: datetime
+    timestamp_ms: int = Field(exclude=True)
     body: str | None
     sender: str
 
+    @computed_field
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp_ms / 1000)
+
 
 class SendMessage(BaseModel):
     conversation_id: str
@@ -43,6 +56,10 @@ class ChatProvider(ABC):
     async def init(self) -> None:
         raise NotImplementedError()
 
+    @abstractmethod
+    async def close(self) -> None:
+        raise NotImplementedError()
+
     @abstractmethod
     async def whoami(self) -> Contact:
         raise NotImplementedError()
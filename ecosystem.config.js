@@ -3,9 +3,9 @@ module.exports = {
     {
       name: "backend",
       cwd: "./backend",
-      script: "poetry run uvicorn main:app --reload --loop asyncio",
+      script: "poetry run uvicorn main:app --reload --loop uvloop --http httptools",
       env: {
-        KEYBASE_COMMAND: "docker exec -u keybase keybase keybase"
+        KEYBASE_COMMAND: "docker exec -i -u keybase keybase keybase"
       }
     },
     {